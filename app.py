@@ -1,7 +1,9 @@
 import os
+import logging
 import uuid
 import requests
 import feedparser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
 from urllib.parse import urlparse
 from werkzeug.utils import secure_filename
@@ -9,6 +11,8 @@ from bs4 import BeautifulSoup
 from PyPDF2 import PdfReader
 from flask import Flask, request, render_template, redirect, url_for, session, jsonify, flash
 from google import genai
+from prompts import PromptBuilder, estimate_tokens
+from scoring import score_summary_citations, score_qa_session, backfill_scores
 from models import db, ResearchSession, Summary, Citation, Document, QASession, RSSFeed, RSSEntry, UsageStats
 
 # IMPORTANT: KEEP THIS COMMENT
@@ -17,6 +21,11 @@ from models import db, ResearchSession, Summary, Citation, Document, QASession,
 # Configure Gemini API
 client = genai.Client(api_key=os.environ.get('GEMINI_API_KEY'))
 
+# Headers sent with outbound scraping and feed requests to avoid blocking
+SCRAPE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
@@ -31,10 +40,25 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_URLS'] = int(os.environ.get('MAX_URLS', 10))  # Per summarize request
+
+# Emit INFO logs (e.g. prompt token usage) outside debug mode too
+app.logger.setLevel(logging.INFO)
+
+# Configure prompt sizes (estimated tokens)
+app.config['PROMPT_TOKEN_BUDGET'] = int(os.environ.get('PROMPT_TOKEN_BUDGET', 4000))
+app.config['SOURCE_TOKEN_LIMIT'] = int(os.environ.get('SOURCE_TOKEN_LIMIT', 1250))  # Per URL or feed entry
+app.config['QUESTION_TOKEN_LIMIT'] = int(os.environ.get('QUESTION_TOKEN_LIMIT', 500))
 
 # Initialize database
 db.init_app(app)
 
+# Outbound URL and feed fetches share a bounded pool so one request's sources download concurrently
+fetch_executor = ThreadPoolExecutor(max_workers=8)
+
+# Relevance scoring runs in the background once a request has committed
+scoring_executor = ThreadPoolExecutor(max_workers=1)
+
 with app.app_context():
     db.create_all()
 
@@ -81,6 +105,76 @@ def get_or_create_session():
     
     return research_session
 
+def fetch_all(fetch, items):
+    """Run fetch on each item concurrently, returning results (or exceptions) in order"""
+    futures = [fetch_executor.submit(fetch, item) for item in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+def scrape_url(url):
+    """Fetch a URL and return its title and cleaned text content"""
+    response = requests.get(url, headers=SCRAPE_HEADERS, timeout=10)
+    response.raise_for_status()
+    
+    # Parse with BeautifulSoup
+    soup = BeautifulSoup(response.content, 'html.parser')
+    
+    # Extract title
+    title = soup.find('title')
+    title_text = title.get_text().strip() if title else url
+    
+    # Remove script and style elements
+    for script in soup(["script", "style"]):
+        script.decompose()
+    
+    # Get text content
+    text = soup.get_text()
+    
+    # Clean up whitespace
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    text = ' '.join(chunk for chunk in chunks if chunk)
+    
+    return title_text, text
+
+def fetch_feed(feed_url):
+    """Download an RSS feed and parse it with feedparser"""
+    response = requests.get(feed_url, headers=SCRAPE_HEADERS, timeout=10)
+    response.raise_for_status()
+    return feedparser.parse(response.content)
+
+def build_prompt(header, footer=""):
+    """Create a prompt builder sized to the configured token budget"""
+    return PromptBuilder(app.config['PROMPT_TOKEN_BUDGET'], header, footer)
+
+def log_prompt_usage(route, usage):
+    """Log how many estimated tokens each source used in a prompt"""
+    for source in usage:
+        status = "dropped" if source['dropped'] else "trimmed" if source['truncated'] else "full"
+        app.logger.info("%s prompt: %s used %d tokens (%s)", route, source['label'], source['tokens'], status)
+
+def schedule_scoring(job, *args):
+    """Run a scoring job off the request path with its own app context"""
+    def run():
+        with app.app_context():
+            try:
+                job(*args)
+            except Exception:
+                # Affected rows keep a 0.0 score until `flask backfill-scores` is run
+                app.logger.exception("Error running %s%s", job.__name__, args)
+    scoring_executor.submit(run)
+
+@app.cli.command('backfill-scores')
+def backfill_scores_command():
+    """Recompute relevance and confidence scores for existing rows"""
+    citations, qa_sessions = backfill_scores()
+    print(f"Scored {citations} citations and {qa_sessions} Q&A sessions")
+
 def update_usage_stats():
     """Update daily usage statistics"""
     today = date.today()
@@ -134,78 +228,74 @@ def summarize():
     if not url_list:
         return render_template('index.html', error="Please enter valid URLs.")
     
+    if len(url_list) > app.config['MAX_URLS']:
+        return render_template('index.html', error=f"Please enter at most {app.config['MAX_URLS']} URLs.", original_urls=urls)
+    
     # Scrape text from all URLs
-    combined_text = ""
+    prompt_builder = build_prompt(
+        "Generate a concise professional summary with key takeaways in bullet points of the following content:"
+    )
     scraping_errors = []
     citations = []
     
+    safe_urls = []
     for url in url_list:
-        try:
-            # Add protocol if missing
-            if not url.startswith(('http://', 'https://')):
-                url = 'https://' + url
-            
-            # Validate URL for security
-            if not is_safe_url(url):
-                scraping_errors.append(f"Invalid or unsafe URL: {url}")
-                continue
-            
-            # Make request with headers to avoid blocking
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            # Parse with BeautifulSoup
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Extract title
-            title = soup.find('title')
-            title_text = title.get_text().strip() if title else url
-            
-            # Remove script and style elements
-            for script in soup(["script", "style"]):
-                script.decompose()
-            
-            # Get text content
-            text = soup.get_text()
-            
-            # Clean up whitespace
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = ' '.join(chunk for chunk in chunks if chunk)
+        # Add protocol if missing
+        if not url.startswith(('http://', 'https://')):
+            url = 'https://' + url
+        
+        # Validate URL for security
+        if not is_safe_url(url):
+            scraping_errors.append(f"Invalid or unsafe URL: {url}")
+            continue
+        
+        safe_urls.append(url)
+    
+    # Fetch all URLs concurrently
+    results = fetch_all(scrape_url, safe_urls)
+    
+    for url, result in zip(safe_urls, results):
+        if isinstance(result, requests.exceptions.RequestException):
+            scraping_errors.append(f"Error accessing {url}: {str(result)}")
+            continue
+        if isinstance(result, Exception):
+            scraping_errors.append(f"Error processing {url}: {str(result)}")
+            continue
+        
+        title_text, text = result
+        
+        # Add to prompt if substantial content found
+        if len(text) > 100:  # Only add if substantial content
+            prompt_builder.add_source(f"Content from {url}:", text,
+                                      max_tokens=app.config['SOURCE_TOKEN_LIMIT'])
             
-            # Add to combined text if substantial content found
-            if len(text) > 100:  # Only add if substantial content
-                content_excerpt = text[:5000]  # Limit per URL
-                combined_text += f"\n\nContent from {url}:\n{content_excerpt}"
-                
-                # Create citation
-                citations.append({
-                    'source_url': url,
-                    'source_title': title_text[:200],
-                    'excerpt': content_excerpt[:500] + "..." if len(content_excerpt) > 500 else content_excerpt
-                })
-            else:
-                scraping_errors.append(f"Little content found at {url}")
-                
-        except requests.exceptions.RequestException as e:
-            scraping_errors.append(f"Error accessing {url}: {str(e)}")
-        except Exception as e:
-            scraping_errors.append(f"Error processing {url}: {str(e)}")
+            # Create citation
+            citations.append({
+                'source_url': url,
+                'source_title': title_text[:200],
+                'excerpt': text[:500] + "..." if len(text) > 500 else text
+            })
+        else:
+            scraping_errors.append(f"Little content found at {url}")
     
     # Handle scraping errors gracefully
-    if not combined_text and scraping_errors:
+    if not citations and scraping_errors:
         error_msg = "Could not extract content from any URLs. " + "; ".join(scraping_errors)
         return render_template('index.html', error=error_msg, original_urls=urls)
     
-    if not combined_text:
+    if not citations:
         return render_template('index.html', error="No substantial content found in any of the URLs.", original_urls=urls)
     
     # Call Gemini API
     try:
-        prompt = f"Generate a concise professional summary with key takeaways in bullet points of the following content:\n\n{combined_text[:15000]}"  # Limit total content
+        prompt, usage = prompt_builder.build()
+        log_prompt_usage('summarize', usage)
+        
+        # Only cite URLs that actually made it into the prompt
+        for cite_data, source in zip(citations, usage):
+            if source['dropped']:
+                scraping_errors.append(f"Skipped {cite_data['source_url']}: prompt budget exceeded")
+        citations = [cite_data for cite_data, source in zip(citations, usage) if not source['dropped']]
         
         response = client.models.generate_content(
             model="gemini-2.5-flash",
@@ -239,8 +329,7 @@ def summarize():
                     source_url=cite_data['source_url'],
                     source_title=cite_data['source_title'],
                     source_type='url',
-                    excerpt=cite_data['excerpt'],
-                    relevance_score=0.8  # Default relevance score
+                    excerpt=cite_data['excerpt']
                 )
                 db.session.add(citation)
             
@@ -249,6 +338,7 @@ def summarize():
             research_session.sources_processed += len(citations)
             
             db.session.commit()
+            schedule_scoring(score_summary_citations, summary.id)
             update_usage_stats()
             
             return render_template('index.html', summary=summary_text, citations=citations)
@@ -349,18 +439,26 @@ def ask_question():
     if not question:
         return jsonify({'error': 'Please enter a question'})
     
+    # Leave most of the prompt budget for the document itself
+    if estimate_tokens(question) > app.config['QUESTION_TOKEN_LIMIT']:
+        return jsonify({'error': 'Question is too long. Please shorten it and try again.'})
+    
     document = Document.query.filter_by(id=doc_id, session_id=research_session.session_id).first()
     if not document:
         return jsonify({'error': 'Document not found'})
     
     try:
         # Use Gemini to answer the question based on document content
-        prompt = f"""Based on the following document content, answer this question: {question}
-
-Document content:
-{document.content[:10000]}  # Limit content length
-
-Please provide a detailed answer based on the document. If the information is not in the document, say so clearly."""
+        prompt_builder = build_prompt(
+            f"Based on the following document content, answer this question: {question}",
+            "Please provide a detailed answer based on the document. If the information is not in the document, say so clearly."
+        )
+        prompt_builder.add_source("Document content:", document.content)
+        prompt, usage = prompt_builder.build()
+        log_prompt_usage('ask_question', usage)
+        
+        if usage[0]['dropped']:
+            return jsonify({'error': 'No room left in the prompt for the document content'})
         
         response = client.models.generate_content(
             model="gemini-2.5-flash",
@@ -373,11 +471,11 @@ Please provide a detailed answer based on the document. If the information is no
                 session_id=research_session.session_id,
                 document_id=doc_id,
                 question=question,
-                answer=response.text,
-                confidence_score=0.85  # Default confidence
+                answer=response.text
             )
             db.session.add(qa_session)
             db.session.commit()
+            schedule_scoring(score_qa_session, qa_session.id)
             
             update_usage_stats()
             
@@ -412,7 +510,7 @@ def add_feed():
     
     try:
         # Parse feed to validate and get info
-        feed = feedparser.parse(feed_url)
+        feed = fetch_feed(feed_url)
         
         if feed.bozo:
             flash('Invalid RSS feed URL')
@@ -427,8 +525,8 @@ def add_feed():
         db.session.add(rss_feed)
         db.session.commit()
         
-        # Parse initial entries
-        update_feed_entries(rss_feed.id)
+        # Parse initial entries from the feed we already downloaded
+        update_feed_entries(rss_feed.id, feed)
         
         flash('RSS feed added successfully!')
         
@@ -437,15 +535,13 @@ def add_feed():
     
     return redirect(url_for('manage_feeds'))
 
-def update_feed_entries(feed_id):
-    """Update entries for a specific RSS feed"""
+def update_feed_entries(feed_id, feed):
+    """Update entries for a specific RSS feed from its parsed content"""
     rss_feed = RSSFeed.query.get(feed_id)
     if not rss_feed:
         return
     
     try:
-        feed = feedparser.parse(rss_feed.url)
-        
         for entry in feed.entries[:10]:  # Limit to latest 10 entries
             # Check if entry already exists
             existing_entry = RSSEntry.query.filter_by(guid=entry.get('id', entry.link)).first()
@@ -512,9 +608,15 @@ def refresh_feeds():
     feeds = RSSFeed.query.filter_by(is_active=True).all()
     updated_count = 0
     
-    for feed in feeds:
+    # Download all feeds concurrently, then store entries one feed at a time
+    results = fetch_all(fetch_feed, [feed.url for feed in feeds])
+    
+    for feed, result in zip(feeds, results):
+        if isinstance(result, Exception):
+            print(f"Error updating feed {feed.id}: {str(result)}")
+            continue
         try:
-            update_feed_entries(feed.id)
+            update_feed_entries(feed.id, result)
             updated_count += 1
         except Exception as e:
             print(f"Error updating feed {feed.id}: {str(e)}")
@@ -536,13 +638,17 @@ def live_summary():
         flash('No new RSS entries to process')
         return redirect(url_for('manage_feeds'))
     
-    # Combine content from recent entries
-    combined_content = ""
+    # Combine content from recent entries, newest first when the budget runs short
+    prompt_builder = build_prompt(
+        "Generate a comprehensive news summary with key trends and insights from these recent RSS feed entries:"
+    )
     sources = []
     
-    for entry in recent_entries:
-        content = f"Title: {entry.title}\nDescription: {entry.description or 'N/A'}\nLink: {entry.link}\n\n"
-        combined_content += content
+    for position, entry in enumerate(recent_entries):
+        prompt_builder.add_source(f"Title: {entry.title}\nLink: {entry.link}",
+                                  f"Description: {entry.description or 'N/A'}",
+                                  priority=-position,
+                                  max_tokens=app.config['SOURCE_TOKEN_LIMIT'])
         sources.append({
             'title': entry.title,
             'link': entry.link,
@@ -551,7 +657,13 @@ def live_summary():
     
     try:
         # Generate summary using Gemini
-        prompt = f"Generate a comprehensive news summary with key trends and insights from these recent RSS feed entries:\n\n{combined_content[:15000]}"
+        prompt, usage = prompt_builder.build()
+        log_prompt_usage('live_summary', usage)
+        
+        # Entries left out of the prompt stay unprocessed for the next live summary
+        included = [not source['dropped'] for source in usage]
+        recent_entries = [entry for entry, keep in zip(recent_entries, included) if keep]
+        sources = [source for source, keep in zip(sources, included) if keep]
         
         response = client.models.generate_content(
             model="gemini-2.5-flash",
@@ -579,12 +691,12 @@ def live_summary():
                     source_url=entry.link,
                     source_title=entry.title,
                     source_type='rss',
-                    excerpt=entry.description[:500] if entry.description else '',
-                    relevance_score=0.7
+                    excerpt=entry.description[:500] if entry.description else ''
                 )
                 db.session.add(citation)
             
             db.session.commit()
+            schedule_scoring(score_summary_citations, summary.id)
             update_usage_stats()
             
             summary_html = response.text.replace('\n', '<br>')
@@ -0,0 +1,103 @@
+"""Token-budget-aware prompt assembly for Gemini requests"""
+import re
+
+# Rough local estimate: English text averages about 4 characters per token
+CHARS_PER_TOKEN = 4
+
+# End of a sentence: terminal punctuation followed by whitespace or end of text
+SENTENCE_END = re.compile(r'[.!?]["\')\]]*(?=\s|$)')
+
+
+def estimate_tokens(text):
+    """Estimate how many tokens a piece of text will use"""
+    if not text:
+        return 0
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def trim_to_tokens(text, max_tokens):
+    """Trim text to fit within max_tokens, cutting at a sentence boundary"""
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    cut = text[:max_tokens * CHARS_PER_TOKEN]
+
+    # Prefer the last complete sentence, unless it would discard most of the window
+    last_end = None
+    for match in SENTENCE_END.finditer(cut):
+        last_end = match.end()
+    if last_end and last_end >= len(cut) // 2:
+        return cut[:last_end]
+
+    # No sentence boundary, fall back to the last whole word
+    if ' ' in cut:
+        return cut.rsplit(' ', 1)[0]
+    return cut
+
+
+class PromptBuilder:
+    """Pack prioritized sources between fixed instructions within a token budget.
+
+    Instructions (header and footer) are always kept whole. Sources are filled
+    in priority order (highest first, ties in insertion order) until the budget
+    runs out; each source may also carry its own token cap.
+    """
+
+    def __init__(self, budget, header, footer=""):
+        self.budget = budget
+        self.header = header
+        self.footer = footer
+        self.sources = []
+
+    def add_source(self, label, text, priority=0, max_tokens=None):
+        self.sources.append({
+            'label': label,
+            'text': text or "",
+            'priority': priority,
+            'max_tokens': max_tokens,
+        })
+
+    def build(self):
+        """Assemble the prompt and report per-source token usage.
+
+        Returns (prompt, usage) where usage is a list of dicts with the label,
+        the tokens used, and whether the source was trimmed or dropped.
+
+        A source's 'tokens' is its full cost in the prompt: the separator and
+        label line plus the packed text. Its max_tokens cap applies to the text
+        alone, so 'tokens' can exceed max_tokens by the label overhead. A
+        dropped source is left out entirely, label included, and reports 0.
+        """
+        remaining = self.budget - estimate_tokens(self.header) - estimate_tokens(f"\n\n{self.footer}")
+
+        packed = {}
+        usage = {}
+        ranked = sorted(enumerate(self.sources), key=lambda item: -item[1]['priority'])
+        for index, source in ranked:
+            # Separators and the label line count against the budget too
+            label_tokens = estimate_tokens(f"\n\n{source['label']}\n")
+            allowance = remaining - label_tokens
+            if source['max_tokens'] is not None:
+                allowance = min(allowance, source['max_tokens'])
+
+            text = trim_to_tokens(source['text'], allowance)
+            if text:
+                packed[index] = f"{source['label']}\n{text}" if source['label'] else text
+                tokens = estimate_tokens(f"\n\n{packed[index]}\n")
+                remaining -= tokens
+            else:
+                tokens = 0
+
+            usage[index] = {
+                'label': source['label'],
+                'tokens': tokens,
+                'truncated': len(text) < len(source['text']),
+                'dropped': not text,
+            }
+
+        # Keep sources in the order they were added
+        parts = [self.header] + [packed[i] for i in sorted(packed)] + [self.footer]
+        prompt = "\n\n".join(part for part in parts if part)
+        return prompt, [usage[i] for i in sorted(usage)]
@@ -0,0 +1,156 @@
+"""Local relevance scoring for citations and Q&A answers"""
+import re
+from collections import Counter
+from itertools import groupby
+import numpy as np
+from sqlalchemy import func, update
+from models import db, Summary, Citation, Document, QASession
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Only the start of an uploaded document is scored, which bounds memory per Q&A pair
+MAX_DOCUMENT_CHARS = 100000
+
+# Q&A answers are compared with document passages of about this many words
+CHUNK_WORDS = 200
+
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'been', 'but', 'by', 'can', 'for', 'from',
+    'has', 'have', 'he', 'her', 'his', 'i', 'if', 'in', 'into', 'is', 'it', 'its', 'not',
+    'of', 'on', 'or', 'our', 's', 'she', 'so', 'that', 'the', 'their', 'them', 'they',
+    'this', 'to', 'was', 'we', 'were', 'which', 'will', 'with', 'you', 'your',
+}
+
+
+def tokenize(text):
+    """Split text into lowercase terms, skipping stop words"""
+    return [term for term in TOKEN_PATTERN.findall((text or "").lower()) if term not in STOP_WORDS]
+
+
+def tfidf_matrix(texts):
+    """Build an L2-normalized TF-IDF matrix with one row per text"""
+    term_counts = [Counter(tokenize(text)) for text in texts]
+    vocabulary = {}
+    for counts in term_counts:
+        for term in counts:
+            vocabulary.setdefault(term, len(vocabulary))
+
+    counts = np.zeros((len(texts), len(vocabulary)), dtype=np.float32)
+    for row, text_counts in enumerate(term_counts):
+        counts[row, [vocabulary[term] for term in text_counts]] = list(text_counts.values())
+
+    # Sublinear term frequency with smoothed inverse document frequency
+    doc_freq = np.count_nonzero(counts, axis=0)
+    idf = (np.log((1 + len(texts)) / (1 + doc_freq)) + 1).astype(np.float32)
+    weights = np.log1p(counts, out=counts)
+    weights *= idf
+
+    norms = np.linalg.norm(weights, axis=1, keepdims=True)
+    return np.divide(weights, norms, out=weights, where=norms > 0)
+
+
+def group_scores(texts, reference):
+    """Cosine similarity between each text and a shared reference text.
+
+    IDF is computed over this group only (the reference plus its texts), so
+    a score depends solely on the group it belongs to, never on what else is
+    being scored at the same time.
+    """
+    if not texts:
+        return np.zeros(0, dtype=np.float32)
+
+    matrix = tfidf_matrix([reference or ""] + [text or "" for text in texts])
+    return matrix[1:] @ matrix[0]
+
+
+def chunk_text(text, words_per_chunk=CHUNK_WORDS):
+    """Split text into consecutive passages of roughly words_per_chunk words"""
+    words = (text or "").split()
+    return [' '.join(words[start:start + words_per_chunk])
+            for start in range(0, len(words), words_per_chunk)]
+
+
+def best_chunk_score(text, document):
+    """Similarity between text and the document passage that matches it best"""
+    chunks = chunk_text(document)
+    if not chunks:
+        return 0.0
+    return float(group_scores(chunks, text).max())
+
+
+def citation_scores(summary_ids):
+    """Score the citations of each summary against that summary's text"""
+    rows = db.session.query(Citation.id, Citation.summary_id, Citation.excerpt, Summary.content)\
+                     .join(Summary, Citation.summary_id == Summary.id)\
+                     .filter(Citation.summary_id.in_(summary_ids))\
+                     .order_by(Citation.summary_id, Citation.id).all()
+
+    updates = []
+    for _, group in groupby(rows, key=lambda row: row.summary_id):
+        group = list(group)
+        scores = group_scores([row.excerpt for row in group], group[0].content)
+        updates += [{'id': row.id, 'relevance_score': round(float(score), 4)}
+                    for row, score in zip(group, scores)]
+    return updates
+
+
+def qa_scores(qa_session_ids):
+    """Score each Q&A answer against the best-matching passage of its document.
+
+    A whole long document shares few terms with any one answer, so comparing
+    against it scores near zero regardless of the answer; the closest passage
+    reflects how well the answer is grounded in the text.
+    """
+    rows = db.session.query(QASession.id, QASession.answer,
+                            func.substr(Document.content, 1, MAX_DOCUMENT_CHARS))\
+                     .join(Document, QASession.document_id == Document.id)\
+                     .filter(QASession.id.in_(qa_session_ids)).all()
+
+    return [{'id': row[0], 'confidence_score': round(best_chunk_score(row[1], row[2]), 4)}
+            for row in rows]
+
+
+def score_summary_citations(summary_id):
+    """Score each citation of a summary against the generated summary text"""
+    _save_scores(Citation, citation_scores([summary_id]))
+
+
+def score_qa_session(qa_session_id):
+    """Score a Q&A answer against the document it was drawn from"""
+    _save_scores(QASession, qa_scores([qa_session_id]))
+
+
+def backfill_scores(summary_batch_size=100, qa_batch_size=10):
+    """Recompute scores for all existing citations and Q&A sessions in batches.
+
+    Batches are whole summaries (or Q&A sessions), so every row is scored in
+    the same group as it would be right after its request.
+
+    Returns (citations_scored, qa_sessions_scored).
+    """
+    return (_backfill(Summary, Citation, citation_scores, summary_batch_size),
+            _backfill(QASession, QASession, qa_scores, qa_batch_size))
+
+
+def _backfill(group_model, model, score, batch_size):
+    scored = 0
+    last_id = 0
+    while True:
+        ids = [row.id for row in db.session.query(group_model.id)
+                                           .filter(group_model.id > last_id)
+                                           .order_by(group_model.id)
+                                           .limit(batch_size)]
+        if not ids:
+            return scored
+        updates = score(ids)
+        _save_scores(model, updates)
+        scored += len(updates)
+        last_id = ids[-1]
+
+
+def _save_scores(model, updates):
+    """Write computed scores back in one bulk update"""
+    if not updates:
+        return
+    db.session.execute(update(model), updates)
+    db.session.commit()